@@ -0,0 +1,102 @@
+import os
+import logging
+import threading
+from pathlib import Path
+from typing import List
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2's sentence-transformers max_seq_length
+
+# Set QA_ONNX_MODEL_DIR to a directory holding an ONNX export of the model
+# (model.int8.onnx or model.onnx plus tokenizer files) to encode with
+# ONNX Runtime instead of torch; see "Encoder Backend" in the README
+ONNX_FILENAMES = ("model.int8.onnx", "model.onnx")
+
+_MODEL = None
+_MODEL_ID = None
+_LOCK = threading.Lock()
+
+class OnnxEncoder:
+    """ONNX Runtime version of the sentence encoder, with the same encode() call as SentenceTransformer"""
+    
+    def __init__(self, model_dir: str, num_threads: int):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        
+        model_path = Path(model_dir)
+        onnx_file = next((model_path / name for name in ONNX_FILENAMES if (model_path / name).exists()), None)
+        if onnx_file is None:
+            raise FileNotFoundError(f"No {' or '.join(ONNX_FILENAMES)} in {model_dir}")
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(onnx_file), options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.model_id = f"{MODEL_NAME}:onnx:{onnx_file.name}"
+        
+        # Embedding width, for empty input; probe the model if the output shape is symbolic
+        dimension = self.session.get_outputs()[0].shape[-1]
+        self.dimension = dimension if isinstance(dimension, int) else self.encode([""]).shape[1]
+    
+    def eval(self) -> "OnnxEncoder":
+        """No-op, matches SentenceTransformer.eval()"""
+        return self
+    
+    def encode(self, texts: List[str], batch_size: int = 32, normalize_embeddings: bool = False,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        """Mean-pooled sentence embeddings as a float32 array"""
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        
+        batches = []
+        for i in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(
+                texts[i:i + batch_size], padding=True, truncation=True,
+                max_length=MAX_SEQ_LENGTH, return_tensors="np"
+            )
+            inputs = {name: tokens[name].astype(np.int64) for name in self.input_names}
+            token_embeddings = self.session.run(None, inputs)[0]
+            
+            # Mean over real tokens only, as the sentence-transformers pooling layer does
+            mask = tokens["attention_mask"][..., None].astype(np.float32)
+            batches.append((token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        
+        embeddings = np.concatenate(batches).astype(np.float32, copy=False)
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+def get_encoder():
+    """Return the process-wide sentence encoder, loading it on first use"""
+    global _MODEL, _MODEL_ID
+    if _MODEL is None:
+        with _LOCK:
+            if _MODEL is None:
+                num_threads = int(os.environ.get("QA_TORCH_THREADS", "4"))
+                onnx_dir = os.environ.get("QA_ONNX_MODEL_DIR")
+                model = None
+                if onnx_dir:
+                    try:
+                        model = OnnxEncoder(onnx_dir, num_threads)
+                        _MODEL_ID = model.model_id
+                    except Exception as e:
+                        # Missing packages or files, or a model ONNX Runtime rejects
+                        logger.warning(f"ONNX encoder unavailable, falling back to sentence-transformers: {str(e)}")
+                if model is None:
+                    import torch
+                    from sentence_transformers import SentenceTransformer
+                    torch.set_num_threads(num_threads)
+                    model = SentenceTransformer(MODEL_NAME)
+                    _MODEL_ID = MODEL_NAME
+                model.eval()
+                _MODEL = model
+    return _MODEL
+
+def get_encoder_id() -> str:
+    """Identifies the loaded encoder backend, so persisted embeddings are rebuilt when it changes"""
+    get_encoder()
+    return _MODEL_ID
@@ -0,0 +1,129 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List
+from django.db import close_old_connections
+from .models import QueryLog
+
+logger = logging.getLogger(__name__)
+
+# A batch is written when it reaches BATCH_SIZE rows or FLUSH_INTERVAL seconds
+# after its first row, whichever comes first
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.1
+
+# Rows beyond MAX_PENDING are dropped (and counted) rather than blocking requests
+MAX_PENDING = 10_000
+
+# How long process exit waits for the writer to finish its current batch
+SHUTDOWN_TIMEOUT = 5.0
+
+# Queued by _shutdown() to make the writer write its batch and exit
+_STOP = object()
+
+_queue = queue.Queue(maxsize=MAX_PENDING)
+_worker = None
+_worker_lock = threading.Lock()
+_dropped = 0
+_dropped_lock = threading.Lock()
+
+def enqueue(entry: Dict[str, Any]) -> None:
+    """Queue a QueryLog row (model field values) to be inserted in the background"""
+    global _dropped
+    start()
+    try:
+        _queue.put_nowait(entry)
+    except queue.Full:
+        with _dropped_lock:
+            _dropped += 1
+
+def dropped() -> int:
+    """Number of rows discarded because the queue was full"""
+    return _dropped
+
+def start() -> None:
+    """Start the writer thread if it is not running yet"""
+    global _worker
+    if _worker is None or not _worker.is_alive():
+        with _worker_lock:
+            if _worker is None or not _worker.is_alive():
+                _worker = threading.Thread(target=_run, name="querylog-writer", daemon=True)
+                _worker.start()
+
+def _reset_after_fork() -> None:
+    """Give a forked child (e.g. a gunicorn --preload worker) its own queue and writer.
+
+    The parent's writer thread does not exist in the child, its locks may have
+    been copied while held, and rows queued by the parent are the parent's to
+    write; the child's writer starts on its first enqueue().
+    """
+    global _queue, _worker, _worker_lock, _dropped, _dropped_lock
+    _queue = queue.Queue(maxsize=MAX_PENDING)
+    _worker = None
+    _worker_lock = threading.Lock()
+    _dropped = 0
+    _dropped_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _shutdown() -> None:
+    """Write every queued row before the process exits.
+
+    The writer is a daemon thread, so without this rows still queued or in its
+    current batch would be lost on a worker restart or autoreload.
+    """
+    worker = _worker
+    if worker is not None and worker.is_alive():
+        try:
+            _queue.put(_STOP, timeout=SHUTDOWN_TIMEOUT)
+            worker.join(SHUTDOWN_TIMEOUT)
+        except queue.Full:
+            pass
+    
+    # Whatever the writer did not get to, or everything if it never ran
+    rows = []
+    while True:
+        try:
+            entry = _queue.get_nowait()
+        except queue.Empty:
+            break
+        if entry is not _STOP:
+            rows.append(entry)
+    for i in range(0, len(rows), BATCH_SIZE):
+        _write(rows[i:i + BATCH_SIZE])
+
+atexit.register(_shutdown)
+
+def _run() -> None:
+    """Collect queued rows into batches and bulk insert them until _STOP is queued"""
+    while True:
+        entry = _queue.get()
+        if entry is _STOP:
+            return
+        batch = [entry]
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entry = _queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                _write(batch)
+                return
+            batch.append(entry)
+        _write(batch)
+
+def _write(batch: List[Dict[str, Any]]) -> None:
+    """Insert a batch of rows; failures are logged and the batch is dropped"""
+    close_old_connections()
+    try:
+        QueryLog.objects.bulk_create([QueryLog(**entry) for entry in batch], batch_size=BATCH_SIZE)
+    except Exception as e:
+        trace_ids = ", ".join(str(entry.get("trace_id")) for entry in batch)
+        logger.error(f"Failed to log {len(batch)} queries - trace_ids: {trace_ids}, error: {str(e)}")
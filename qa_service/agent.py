@@ -1,128 +1,315 @@
 import re
 import json
 import time
-from typing import Dict, Any, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, Any, List, NamedTuple, Optional, Set, Tuple
 import logging
-import ollama
-from .knowledge_base import KnowledgeBase
+import threading
+from contextlib import asynccontextmanager
+import ahocorasick
+from cachetools import TTLCache
 from .tools import SettlementCalculator, TerzaghiBearingCapacity
 
+# ollama and the knowledge base (sentence-transformers, torch, faiss) are
+# imported on first use so Django startup and management commands stay light
+if TYPE_CHECKING:
+    from .knowledge_base import KnowledgeBase
+
 logger = logging.getLogger(__name__)
 
+# All calculation parameters in one alternation; the named group of each match
+# says which parameter it is, so a single scan extracts everything. Young's
+# modulus can be written three ways, resolved in priority order afterwards.
+# Values only match well-formed numbers, so a stray "2024.05.01" elsewhere in
+# the text cannot reach float().
+NUMBER = r'[0-9]*\.?[0-9]+'
+PARAM_RE = re.compile(
+    rf'load[s]?\s*[=:]\s*(?P<load>{NUMBER})'
+    rf'|young[\'s\s]*modulus[s]?\s*[=:]\s*(?P<youngs_modulus>{NUMBER})'
+    rf'|modulus[s]?\s*[=:]\s*(?P<modulus>{NUMBER})'
+    rf'|friction[_\s]*angle\s*[=:]\s*(?P<friction_angle>{NUMBER})'
+    rf'|gamma\s*[=:]\s*(?P<gamma>{NUMBER})'
+    rf'|df\s*[=:]\s*(?P<Df>{NUMBER})'
+    rf'|b\s*[=:]\s*(?P<B>{NUMBER})'
+    rf'|e\s*[=:]\s*(?P<e>{NUMBER})',
+    re.IGNORECASE
+)
+MODULUS_KEYS = ('youngs_modulus', 'modulus', 'e')
+BEARING_KEYS = ('B', 'gamma', 'Df', 'friction_angle')
+
+# Tool-selection and domain keywords, compiled into one Aho-Corasick automaton
+# that maps each keyword to its category so a single pass over the question
+# gates both tools and the out-of-scope prefilter
+SETTLEMENT_KEYWORDS = [
+    "settlement", "immediate settlement", "elastic settlement",
+    "load", "young", "modulus", "settlement = load",
+    "calculate settlement", "settlement calculation"
+]
+BEARING_KEYWORDS = [
+    "bearing capacity", "ultimate bearing", "terzaghi", "qu", "q_ult",
+    "bearing", "footing", "foundation capacity", "nq", "nr", "friction angle"
+]
+DOMAIN_KEYWORDS = [
+    "cpt", "cone penetration", "liquefaction", "settle3", "rocscience",
+    "geotechnical", "soil", "clay", "sand", "foundation", "consolidation",
+    "compression", "stress", "strain", "shear", "pore", "spt", "seismic",
+    # Terms the knowledge base documents define
+    "tip resistance", "sleeve friction", "friction ratio", "behavior type",
+    "cyclic resistance", "cyclic stress", "fines content", "magnitude scaling",
+    "overburden", "factor of safety", "robertson", "boulanger", "idriss",
+    "kulhawy", "undrained", "poisson", "dissipation", "embankment"
+]
+# Acronyms from the knowledge base documents; too short to match as substrings
+# ("ic" is in "basic"), so they only count as whole words
+DOMAIN_ACRONYM_RE = re.compile(
+    r'\b(?:qc|qc1n|qt|fs|rf|ic|crr|csr|msf|fc|sbt|su|nkt|cv|cc|cr|pga)\b', re.IGNORECASE
+)
+KEYWORD_CATEGORIES = {
+    "settlement": SETTLEMENT_KEYWORDS,
+    "bearing": BEARING_KEYWORDS,
+    "domain": DOMAIN_KEYWORDS
+}
+
+def _keyword_automaton(categories: Dict[str, List[str]]) -> ahocorasick.Automaton:
+    """Build an automaton whose matches report the category of the keyword found"""
+    automaton = ahocorasick.Automaton()
+    for category, keywords in categories.items():
+        for keyword in keywords:
+            automaton.add_word(keyword, category)
+    automaton.make_automaton()
+    return automaton
+
+KEYWORD_AC = _keyword_automaton(KEYWORD_CATEGORIES)
+
+# Questions this short with no domain keyword skip retrieval and generation
+OUT_OF_SCOPE_MAX_WORDS = 3
+OUT_OF_SCOPE_ANSWER = (
+    "This service answers geotechnical questions about settlement, bearing capacity, "
+    "CPT and liquefaction analysis, and Settle3. Please rephrase your question with more detail."
+)
+
+# Start of the answer text when the Ollama call fails
+OLLAMA_ERROR_PREFIX = "Error calling Ollama: "
+
+# Questions asking for an explanation still go to Ollama after a tool answered
+EXPLANATION_RE = re.compile(r'\b(?:explain|describe|elaborate|why)\b', re.IGNORECASE)
+
+# Knowledge base context given to Ollama, in whitespace-delimited tokens per snippet;
+# 40 tokens averages ~305 characters on the bundled documents, on par with the old 300-character cut
+SNIPPET_TOKEN_BUDGET = 40
+
+def _truncate_tokens(text: str, budget: int = SNIPPET_TOKEN_BUDGET) -> str:
+    """Keep the first `budget` whitespace-delimited tokens of text"""
+    # maxsplit stops scanning once the budget is reached; the remainder lands in the last item
+    return " ".join(text.split(None, budget)[:budget])
+
+@asynccontextmanager
+async def ollama_async_client():
+    """One ollama.AsyncClient, so its HTTP connections are reused, closed on exit"""
+    import ollama
+    
+    client = ollama.AsyncClient()
+    try:
+        yield client
+    finally:
+        # ollama 0.1.7 has no close(); the httpx.AsyncClient it wraps does
+        await client._client.aclose()
+
+class TraceStep(NamedTuple):
+    """One step of the agent pipeline, kept compact until the response is built"""
+    step: str
+    duration_ns: Optional[int] = None
+    extra: Optional[Dict[str, Any]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Flatten into the trace entry shape returned by the API"""
+        data = {"step": self.step}
+        if self.duration_ns is not None:
+            data["duration_ms"] = self.duration_ns / 1e6
+        if self.extra:
+            data.update(self.extra)
+        return data
+
 class TechnicalAgent:
-    def __init__(self):
-        self.kb = KnowledgeBase()
+    def __init__(self, kb: Optional["KnowledgeBase"] = None):
+        self._kb = kb
         self.settlement_calc = SettlementCalculator()
         self.bearing_capacity = TerzaghiBearingCapacity()
         self.ollama_model = "gemma2:2b"  # Specify the Ollama model to use
+        # Recent retrieval results keyed by (query, k); shared across requests
+        self._search_cache = TTLCache(maxsize=512, ttl=3600)
+        self._search_lock = threading.Lock()
 
-    def _should_use_settlement_tool(self, question: str) -> bool:
-        """Determine if settlement calculation tool should be used"""
-        settlement_keywords = [
-            "settlement", "immediate settlement", "elastic settlement",
-            "load", "young", "modulus", "settlement = load",
-            "calculate settlement", "settlement calculation"
-        ]
-        question_lower = question.lower()
-        return any(keyword in question_lower for keyword in settlement_keywords)
-
-    def _should_use_bearing_capacity_tool(self, question: str) -> bool:
-        """Determine if bearing capacity tool should be used"""
-        bearing_keywords = [
-            "bearing capacity", "ultimate bearing", "terzaghi", "qu", "q_ult",
-            "bearing", "footing", "foundation capacity", "nq", "nr", "friction angle"
-        ]
-        question_lower = question.lower()
-        return any(keyword in question_lower for keyword in bearing_keywords)
-
-    def _extract_settlement_params(self, question: str, context: str = "") -> Optional[Tuple[float, float]]:
-        """Extract load and Young's modulus from question"""
-        text = f"{question} {context}".lower()
-        
-        # Look for patterns like "load = 100", "youngs modulus = 25000", etc.
-        load_match = re.search(r'load[s]?\s*[=:]\s*([0-9.]+)', text)
-        modulus_patterns = [
-            r'young[\'s\s]*modulus[s]?\s*[=:]\s*([0-9.]+)',
-            r'modulus[s]?\s*[=:]\s*([0-9.]+)',
-            r'e\s*[=:]\s*([0-9.]+)'
-        ]
-        
-        load = None
-        modulus = None
-        
-        if load_match:
-            load = float(load_match.group(1))
-        
-        for pattern in modulus_patterns:
-            modulus_match = re.search(pattern, text)
-            if modulus_match:
-                modulus = float(modulus_match.group(1))
-                break
+    @property
+    def kb(self) -> "KnowledgeBase":
+        """Knowledge base, loaded on first use so constructing the agent stays cheap"""
+        if self._kb is None:
+            from .knowledge_base import get_knowledge_base
+            self._kb = get_knowledge_base()
+        return self._kb
+
+    def retrieve(self, query: str, k: int = 3) -> List[Dict[str, Any]]:
+        """Search the knowledge base, reusing cached results for repeated queries"""
+        key = (query, k)
+        with self._search_lock:
+            results = self._search_cache.get(key)
+        if results is None:
+            results = self.kb.search(query, k=k)
+            with self._search_lock:
+                self._search_cache[key] = results
+        return results
+
+    def _detect_categories(self, question: str) -> Set[str]:
+        """
+        Determine which keyword categories the question mentions:
+        "settlement" and "bearing" select tools, "domain" marks it as on-topic
+        """
+        categories = {category for _, category in KEYWORD_AC.iter(question.lower())}
+        if "domain" not in categories and DOMAIN_ACRONYM_RE.search(question):
+            categories.add("domain")
+        return categories
+
+    def _extract_params(self, text: str) -> Dict[str, float]:
+        """Extract all calculation parameters from the combined question and context in one scan"""
+        # Patterns are case-insensitive, so the text is scanned as-is.
+        # Look for patterns like "load = 100", "youngs modulus = 25000", "B = 2", etc.
+        # The first occurrence of each parameter wins.
+        params = {}
+        for match in PARAM_RE.finditer(text):
+            name = match.lastgroup
+            if name not in params:
+                params[name] = float(match.group(name))
+        return params
+
+    def _extract_settlement_params(self, params: Dict[str, float]) -> Optional[Tuple[float, float]]:
+        """Pick load and Young's modulus from the extracted parameters"""
+        load = params.get('load')
+        modulus = next((params[key] for key in MODULUS_KEYS if key in params), None)
         
         if load is not None and modulus is not None:
             return (load, modulus)
         return None
 
-    def _extract_bearing_capacity_params(self, question: str, context: str = "") -> Optional[Dict[str, float]]:
-        """Extract bearing capacity parameters from question"""
-        text = f"{question} {context}".lower()
-        
-        params = {}
-        
-        # Extract parameters using regex patterns
-        patterns = {
-            'B': r'b\s*[=:]\s*([0-9.]+)',
-            'gamma': r'gamma\s*[=:]\s*([0-9.]+)',
-            'Df': r'df\s*[=:]\s*([0-9.]+)',
-            'friction_angle': r'friction[_\s]*angle\s*[=:]\s*([0-9.]+)'
-        }
-        
-        for param, pattern in patterns.items():
-            match = re.search(pattern, text)
-            if match:
-                params[param] = float(match.group(1))
-        
+    def _extract_bearing_capacity_params(self, params: Dict[str, float]) -> Optional[Dict[str, float]]:
+        """Pick bearing capacity parameters from the extracted parameters"""
         # Check if we have all required parameters
-        if len(params) == 4:
-            return params
+        if all(key in params for key in BEARING_KEYS):
+            return {key: params[key] for key in BEARING_KEYS}
         return None
 
-    def _call_ollama(self, prompt: str) -> str:
-        """Call Ollama to generate a response"""
+    def _call_ollama(self, prompt: str) -> Tuple[str, Optional[float]]:
+        """
+        Stream a response from Ollama.
+        Returns the generated text and the time to first token in ms
+        (None if nothing was received).
+        """
+        import ollama
+        
+        start = time.perf_counter_ns()
+        ttft_ms = None
+        parts = []
+        try:
+            for chunk in ollama.generate(model=self.ollama_model, prompt=prompt, stream=True):
+                if ttft_ms is None:
+                    ttft_ms = (time.perf_counter_ns() - start) / 1e6
+                parts.append(chunk['response'])
+            return "".join(parts).strip(), ttft_ms
+        except Exception as e:
+            logger.error(f"Ollama call failed: {str(e)}")
+            return f"{OLLAMA_ERROR_PREFIX}{str(e)}", ttft_ms
+
+    async def _acall_ollama(self, prompt: str, client) -> Tuple[str, Optional[float]]:
+        """Async variant of _call_ollama so several generations can be in flight"""
+        start = time.perf_counter_ns()
+        ttft_ms = None
+        parts = []
         try:
-            response = ollama.generate(model=self.ollama_model, prompt=prompt)
-            return response['response'].strip()
+            stream = await client.generate(model=self.ollama_model, prompt=prompt, stream=True)
+            async for chunk in stream:
+                if ttft_ms is None:
+                    ttft_ms = (time.perf_counter_ns() - start) / 1e6
+                parts.append(chunk['response'])
+            return "".join(parts).strip(), ttft_ms
         except Exception as e:
             logger.error(f"Ollama call failed: {str(e)}")
-            return f"Error calling Ollama: {str(e)}"
+            return f"{OLLAMA_ERROR_PREFIX}{str(e)}", ttft_ms
 
     def process_question(self, question: str, context: str = "") -> Dict[str, Any]:
         """Main agent logic to process questions"""
-        trace_steps = []
-        start_time = time.time()
+        pipeline = self._pipeline(question, context)
+        try:
+            prompt = next(pipeline)
+            while True:
+                prompt = pipeline.send(self._call_ollama(prompt))
+        except StopIteration as done:
+            return done.value
+
+    async def aprocess_question(self, question: str, context: str = "", client=None) -> Dict[str, Any]:
+        """
+        Async variant of process_question; only the Ollama call is awaited.
+        Pass an ollama.AsyncClient to share its connections across questions.
+        """
+        if client is None:
+            async with ollama_async_client() as client:
+                return await self.aprocess_question(question, context, client)
+        
+        pipeline = self._pipeline(question, context)
+        try:
+            prompt = next(pipeline)
+            while True:
+                prompt = pipeline.send(await self._acall_ollama(prompt, client))
+        except StopIteration as done:
+            return done.value
+
+    def _pipeline(self, question: str, context: str):
+        """
+        Agent logic shared by the sync and async entry points.
+        Yields each Ollama prompt and expects the (text, ttft_ms) pair from
+        _call_ollama to be sent back; the processed result is the generator's
+        return value.
+        """
+        trace_steps: List[TraceStep] = []
+        start = time.perf_counter_ns()
+        accumulated_ns = 0  # time already attributed to trace steps
         
         try:
             # Step 1: Decide what to do
-            use_settlement = self._should_use_settlement_tool(question)
-            use_bearing = self._should_use_bearing_capacity_tool(question)
+            categories = self._detect_categories(question)
+            use_settlement = "settlement" in categories
+            use_bearing = "bearing" in categories
             use_retrieval = True  # Always try retrieval for context
             
+            # Short questions with no domain signal at all are out of scope;
+            # answer them before paying for retrieval and generation
+            if not categories and not context and len(question.split()) <= OUT_OF_SCOPE_MAX_WORDS:
+                total_ns = time.perf_counter_ns() - start
+                return {
+                    "answer": OUT_OF_SCOPE_ANSWER,
+                    "citations": [],
+                    "tools_used": [],
+                    "retrieval_used": False,
+                    "trace": [TraceStep("out_of_scope", total_ns).to_dict()],
+                    "total_duration_ms": total_ns / 1e6,
+                    "failed": False
+                }
+            
             citations = []
             answer_parts = []
             tools_used = []
+            tool_failed = False
+            generation_failed = False
+            search_results = []
             
             # Step 2: Retrieval
             if use_retrieval:
-                retrieval_start = time.time()
-                search_results = self.kb.search(question, k=3)
-                retrieval_time = (time.time() - retrieval_start) * 1000
+                retrieval_start = time.perf_counter_ns()
+                search_results = self.retrieve(question, k=3)
+                retrieval_ns = time.perf_counter_ns() - retrieval_start
+                accumulated_ns += retrieval_ns
                 
-                trace_steps.append({
-                    "step": "retrieval",
-                    "duration_ms": round(retrieval_time, 2),
+                trace_steps.append(TraceStep("retrieval", retrieval_ns, {
                     "results_count": len(search_results),
                     "top_score": search_results[0]['score'] if search_results else 0
-                })
+                }))
                 
                 if search_results:
                     citations = [
@@ -135,9 +322,12 @@ class TechnicalAgent:
                     ]
             
             # Step 3: Tool usage
+            if use_settlement or use_bearing:
+                extracted_params = self._extract_params(f"{question} {context}")
+            
             if use_settlement:
-                tool_start = time.time()
-                params = self._extract_settlement_params(question, context)
+                tool_start = time.perf_counter_ns()
+                params = self._extract_settlement_params(extracted_params)
                 if params:
                     load, modulus = params
                     try:
@@ -148,14 +338,14 @@ class TechnicalAgent:
                             f"Formula used: {result['formula']}"
                         )
                         
-                        tool_time = (time.time() - tool_start) * 1000
-                        trace_steps.append({
-                            "step": "settlement_tool",
-                            "duration_ms": round(tool_time, 2),
+                        tool_ns = time.perf_counter_ns() - tool_start
+                        accumulated_ns += tool_ns
+                        trace_steps.append(TraceStep("settlement_tool", tool_ns, {
                             "inputs": result['inputs'],
                             "result": result['settlement']
-                        })
+                        }))
                     except Exception as e:
+                        tool_failed = True
                         answer_parts.append(f"Error in settlement calculation: {str(e)}")
                 else:
                     answer_parts.append(
@@ -164,8 +354,8 @@ class TechnicalAgent:
                     )
             
             if use_bearing:
-                tool_start = time.time()
-                params = self._extract_bearing_capacity_params(question, context)
+                tool_start = time.perf_counter_ns()
+                params = self._extract_bearing_capacity_params(extracted_params)
                 if params:
                     try:
                         result = self.bearing_capacity.calculate(**params)
@@ -175,14 +365,14 @@ class TechnicalAgent:
                             f"Factors used: Nq = {result['factors']['Nq']}, Nr = {result['factors']['Nr']}"
                         )
                         
-                        tool_time = (time.time() - tool_start) * 1000
-                        trace_steps.append({
-                            "step": "bearing_capacity_tool",
-                            "duration_ms": round(tool_time, 2),
+                        tool_ns = time.perf_counter_ns() - tool_start
+                        accumulated_ns += tool_ns
+                        trace_steps.append(TraceStep("bearing_capacity_tool", tool_ns, {
                             "inputs": result['inputs'],
                             "result": result['ultimate_bearing_capacity']
-                        })
+                        }))
                     except Exception as e:
+                        tool_failed = True
                         answer_parts.append(f"Error in bearing capacity calculation: {str(e)}")
                 else:
                     answer_parts.append(
@@ -191,43 +381,67 @@ class TechnicalAgent:
                         "Format: 'Calculate bearing capacity for B = X, gamma = Y, Df = Z, friction angle = A'"
                     )
             
-            # Step 4: Use Ollama for general questions or to enhance answers
-            if not answer_parts or (search_results and not tools_used):
-                tool_start = time.time()
+            # Step 4: Use Ollama for general questions or to enhance answers.
+            # Tool output is authoritative, so Ollama only runs after a tool when
+            # the question asks for an explanation, and never after a tool error.
+            # Without retrieved context there is nothing to ground the answer on.
+            if not search_results:
+                skip_reason = "no_context"
+            elif tool_failed:
+                skip_reason = "tool_error"
+            elif tools_used and not EXPLANATION_RE.search(question):
+                skip_reason = "tool_answered"
+            else:
+                skip_reason = None
+            
+            if skip_reason:
+                trace_steps.append(TraceStep("ollama_skipped", extra={"reason": skip_reason}))
+            else:
+                tool_start = time.perf_counter_ns()
+                snippets = "\n".join([
+                    f"{result['title']}: {_truncate_tokens(self.kb.get_content(result['index']))}"
+                    for result in search_results
+                ])
+                # Stable context first and the question last: questions that retrieve
+                # the same documents share a byte-identical prompt prefix, which
+                # Ollama's prompt cache can reuse instead of prefilling it again
                 ollama_prompt = (
+                    "Context from knowledge base:\n"
+                    f"{snippets}\n\n"
+                    "Provide a concise and accurate answer based on the context and question.\n\n"
                     f"Question: {question}\n"
-                    f"Context from knowledge base:\n"
-                    + "\n".join([f"{result['title']}: {result['content'][:300]}" for result in search_results])
-                    + "\n\nProvide a concise and accurate answer based on the context and question."
+                    "Answer:"
                 )
-                ollama_response = self._call_ollama(ollama_prompt)
+                ollama_response, ttft_ms = yield ollama_prompt
+                generation_failed = ollama_response.startswith(OLLAMA_ERROR_PREFIX)
                 answer_parts.append(ollama_response)
-                trace_steps.append({
-                    "step": "ollama_generation",
-                    "duration_ms": round((time.time() - tool_start) * 1000, 2)
-                })
+                generation_ns = time.perf_counter_ns() - tool_start
+                accumulated_ns += generation_ns
+                trace_steps.append(TraceStep("ollama_generation", generation_ns, {
+                    "ttft_ms": ttft_ms
+                }))
             
             # Step 5: Generate final answer
-            if answer_parts:
+            if len(answer_parts) == 1:
+                final_answer = answer_parts[0]
+            elif answer_parts:
                 final_answer = " ".join(answer_parts)
             else:
                 final_answer = "I couldn't find specific information to answer your question. " + \
                              "Please provide more details or check if your question relates to " + \
                              "settlement calculations, bearing capacity analysis, or CPT/liquefaction analysis."
             
-            total_time = (time.time() - start_time) * 1000
-            trace_steps.append({
-                "step": "final_answer_generation",
-                "duration_ms": round(total_time - sum(step.get('duration_ms', 0) for step in trace_steps), 2)
-            })
+            total_ns = time.perf_counter_ns() - start
+            trace_steps.append(TraceStep("final_answer_generation", total_ns - accumulated_ns))
             
             return {
                 "answer": final_answer,
                 "citations": citations,
                 "tools_used": tools_used,
                 "retrieval_used": use_retrieval,
-                "trace": trace_steps,
-                "total_duration_ms": round(total_time, 2)
+                "trace": [step.to_dict() for step in trace_steps],
+                "total_duration_ms": total_ns / 1e6,
+                "failed": generation_failed
             }
             
         except Exception as e:
@@ -237,6 +451,7 @@ class TechnicalAgent:
                 "citations": [],
                 "tools_used": [],
                 "retrieval_used": False,
-                "trace": trace_steps,
-                "total_duration_ms": round((time.time() - start_time) * 1000, 2)
+                "trace": [step.to_dict() for step in trace_steps],
+                "total_duration_ms": (time.perf_counter_ns() - start) / 1e6,
+                "failed": True
             }
\ No newline at end of file
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class QaServiceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'qa_service'
+    
+    def ready(self):
+        from . import _log_queue
+        _log_queue.start()
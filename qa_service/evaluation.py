@@ -1,11 +1,20 @@
+import asyncio
 from typing import List, Dict, Any, Tuple
-from .knowledge_base import KnowledgeBase
-from .agent import TechnicalAgent
+import ahocorasick
+from .agent import TechnicalAgent, ollama_async_client
+
+def _keyword_automaton(keywords: List[str]) -> ahocorasick.Automaton:
+    """Build an Aho-Corasick automaton whose matches report the keyword's index"""
+    automaton = ahocorasick.Automaton()
+    for index, keyword in enumerate(keywords):
+        automaton.add_word(keyword, index)
+    automaton.make_automaton()
+    return automaton
 
 class EvaluationSuite:
     def __init__(self):
-        self.kb = KnowledgeBase()
         self.agent = TechnicalAgent()
+        self.kb = self.agent.kb
         
         self.qa_pairs = [
             {
@@ -51,6 +60,13 @@ class EvaluationSuite:
                 "expected_keywords": ["bearing capacity factors", "terzaghi", "friction angle", "nq", "nr"]
             }
         ]
+        
+        # Answers are compared in lower case; normalise the static keywords once
+        # and compile them into one automaton per QA pair for single-pass matching
+        for qa in self.qa_pairs:
+            qa["_lc_keywords"] = [kw.lower() for kw in qa["expected_keywords"]]
+            if qa["_lc_keywords"]:
+                qa["_automaton"] = _keyword_automaton(qa["_lc_keywords"])
     
     def evaluate_retrieval(self, k: int = 3) -> Dict[str, Any]:
         """Evaluate retrieval performance"""
@@ -63,7 +79,8 @@ class EvaluationSuite:
         for qa in self.qa_pairs:
             if qa["expected_sources"]:  # Only evaluate retrieval questions
                 total_questions += 1
-                search_results = self.kb.search(qa["question"], k=k)
+                # Goes through the agent's cache so evaluate_answers reuses these results
+                search_results = self.agent.retrieve(qa["question"], k=k)
                 
                 retrieved_sources = [result["filename"] for result in search_results]
                 expected_sources = qa["expected_sources"]
@@ -92,7 +109,19 @@ class EvaluationSuite:
             "details": results_detail
         }
     
-    def evaluate_answers(self) -> Dict[str, Any]:
+    async def _collect_answers(self, concurrency: int) -> List[Dict[str, Any]]:
+        """Run the agent on every QA pair with at most `concurrency` Ollama calls in flight"""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        # One client for the run, so questions reuse its connection pool
+        async with ollama_async_client() as client:
+            async def answer(question: str) -> Dict[str, Any]:
+                async with semaphore:
+                    return await self.agent.aprocess_question(question, client=client)
+            
+            return await asyncio.gather(*[answer(qa["question"]) for qa in self.qa_pairs])
+    
+    def evaluate_answers(self, concurrency: int = 4) -> Dict[str, Any]:
         """Evaluate answer quality using keyword matching"""
         keyword_matches = 0
         total_questions = len(self.qa_pairs)
@@ -101,13 +130,16 @@ class EvaluationSuite:
         
         results_detail = []
         
-        for qa in self.qa_pairs:
-            result = self.agent.process_question(qa["question"])
+        answers = asyncio.run(self._collect_answers(concurrency))
+        for qa, result in zip(self.qa_pairs, answers):
             answer = result["answer"].lower()
-            expected_keywords = [kw.lower() for kw in qa["expected_keywords"]]
+            expected_keywords = qa["_lc_keywords"]
             
-            # Check keyword overlap
-            matches = sum(1 for keyword in expected_keywords if keyword in answer)
+            # Check keyword overlap: one scan of the answer finds every distinct keyword
+            if expected_keywords:
+                matches = len({index for _, index in qa["_automaton"].iter(answer)})
+            else:
+                matches = 0
             keyword_score = matches / len(expected_keywords) if expected_keywords else 0
             
             if keyword_score > 0.5:  # At least half keywords match
@@ -1,21 +1,40 @@
 import json
+import hashlib
+import logging
 import numpy as np
-from sentence_transformers import SentenceTransformer
 import faiss
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Optional
 import os
+import threading
+from functools import lru_cache
 from pathlib import Path
+from ._embed_model import get_encoder, get_encoder_id
+
+logger = logging.getLogger(__name__)
+
+_KB = None
+_KB_LOCK = threading.Lock()
 
 class KnowledgeBase:
     def __init__(self, data_dir: str = "knowledge_data"):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
         
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.documents = []
+        self.model = get_encoder()
+        
+        # Document fields as parallel lists, row-aligned with the embeddings
+        self.ids: List[str] = []
+        self.titles: List[str] = []
+        self.filenames: List[str] = []
+        self.contents: List[str] = []
         self.embeddings = None
         self.index = None
         
+        # Encoded corpus cache, reused while meta.json matches the model and documents
+        self._index_path = self.data_dir / "faiss.index"
+        self._emb_path = self.data_dir / "embeddings.f32"
+        self._meta_path = self.data_dir / "meta.json"
+        
         self._create_knowledge_documents()
         self._build_index()
     
@@ -231,40 +250,182 @@ Modern software like Settle3 integrates these methods with CPT data for comprehe
             }
         ]
         
-        self.documents = documents
+        self.ids = [doc["id"] for doc in documents]
+        self.titles = [doc["title"] for doc in documents]
+        self.filenames = [doc["filename"] for doc in documents]
+        self.contents = [doc["content"] for doc in documents]
         
-        # Save documents to files
+        # Save documents to files, skipping those already on disk unless the
+        # documents changed since meta.json was written
+        existing = set()
+        stored_meta = self._read_meta()
+        if stored_meta is not None and stored_meta.get("hash") == self._content_hash():
+            with os.scandir(self.data_dir) as entries:
+                existing = {entry.name for entry in entries if entry.is_file()}
         for doc in documents:
-            file_path = self.data_dir / doc["filename"]
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(doc["content"])
+            if doc["filename"] not in existing:
+                (self.data_dir / doc["filename"]).write_text(doc["content"], encoding='utf-8')
+    
+    @property
+    def documents(self) -> List[Dict[str, str]]:
+        """Documents as a list of dicts, built on demand"""
+        return [
+            {"id": doc_id, "title": title, "filename": filename, "content": content}
+            for doc_id, title, filename, content in zip(self.ids, self.titles, self.filenames, self.contents)
+        ]
+    
+    def get_content(self, idx: int) -> str:
+        """Full text of the document at row idx"""
+        return self.contents[idx]
+    
+    def _content_hash(self) -> str:
+        """SHA-256 over the document contents"""
+        digest = hashlib.sha256()
+        for content in self.contents:
+            digest.update(content.encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _fingerprint(self) -> Dict[str, str]:
+        """Identify the embedding model and document set the cached index was built from"""
+        return {"model": get_encoder_id(), "index": "SQ8", "hash": self._content_hash()}
+    
+    def _read_meta(self) -> Optional[Dict[str, str]]:
+        """Fingerprint stored in meta.json, or None if missing or unreadable"""
+        try:
+            with open(self._meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _load_index(self, meta: Dict[str, str]) -> bool:
+        """Load the persisted index and embeddings if they match meta"""
+        stored = self._read_meta()
+        if stored is None or {key: stored.get(key) for key in meta} != meta:
+            return False
+        try:
+            # Raw float32 rows mapped read-only, so forked workers share the pages
+            self.embeddings = np.memmap(
+                self._emb_path, dtype=np.float32, mode='r', shape=(len(self.ids), int(stored["dim"]))
+            )
+        except (KeyError, TypeError, OSError, ValueError):
+            return False
+        
+        try:
+            self.index = faiss.read_index(
+                str(self._index_path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+            )
+            if self.index.ntotal == len(self.ids) and self.index.d == self.embeddings.shape[1]:
+                return True
+        except (OSError, RuntimeError):
+            pass
+        
+        # The embeddings are intact, so only the index needs rebuilding; no re-encoding
+        logger.warning("Knowledge base index unreadable, rebuilding it from the saved embeddings")
+        self._index_embeddings()
+        self._save_index(meta, embeddings=False)
+        return True
+    
+    def _save_index(self, meta: Dict[str, str], embeddings: bool = True):
+        """Persist the index, embeddings and fingerprint to data_dir"""
+        def write_meta(path: str):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(dict(meta, dim=int(self.embeddings.shape[1])), f)
+        
+        try:
+            # meta.json goes last, so a crash part-way leaves a fingerprint that
+            # no longer matches and the next start rebuilds
+            _write_atomic(self._index_path, lambda path: faiss.write_index(self.index, path))
+            if embeddings:
+                _write_atomic(self._emb_path, self.embeddings.tofile)
+            _write_atomic(self._meta_path, write_meta)
+        except (OSError, RuntimeError) as e:
+            logger.warning(f"Could not persist knowledge base index: {str(e)}")
+    
+    def _encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """Encode texts to L2-normalized float32 embeddings (cosine similarity via inner product)"""
+        embeddings = self.model.encode(
+            texts,
+            batch_size=batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        # FAISS copies any input that is not C-contiguous float32; convert once here
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
     
     def _build_index(self):
         """Build FAISS index for similarity search"""
-        texts = [doc["content"] for doc in self.documents]
-        self.embeddings = self.model.encode(texts)
+        meta = self._fingerprint()
+        if self._load_index(meta):
+            return
         
-        # Create FAISS index
+        self.embeddings = self._encode(self.contents)
+        self._index_embeddings()
+        self._save_index(meta)
+    
+    def _index_embeddings(self):
+        """Create the FAISS index over self.embeddings"""
+        # 8-bit scalar quantization keeps a quarter of the FP32 footprint,
+        # inner product on normalized vectors is cosine similarity
         dimension = self.embeddings.shape[1]
-        self.index = faiss.IndexFlatIP(dimension)  # Inner product for cosine similarity
-        
-        # Normalize embeddings for cosine similarity
-        faiss.normalize_L2(self.embeddings)
+        self.index = faiss.IndexScalarQuantizer(
+            dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        self.index.train(self.embeddings)
         self.index.add(self.embeddings)
     
     def search(self, query: str, k: int = 3) -> List[Dict[str, Any]]:
         """Search for relevant documents"""
-        query_embedding = self.model.encode([query])
-        faiss.normalize_L2(query_embedding)
+        query_embedding = np.frombuffer(
+            _encode_query(query.strip().lower()), dtype=np.float32
+        ).reshape(1, -1)
         
         scores, indices = self.index.search(query_embedding, k)
         
-        results = []
-        for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx < len(self.documents):
-                doc = self.documents[idx].copy()
-                doc['score'] = float(score)
-                doc['rank'] = i + 1
-                results.append(doc)
+        # FAISS pads with -1 (always at the end) when k exceeds the number of
+        # indexed documents; drop those slots in one pass and convert to Python
+        # ints/floats in bulk
+        valid = indices[0] >= 0
+        hit_indices = indices[0][valid].tolist()
+        hit_scores = scores[0][valid].tolist()
         
-        return results
\ No newline at end of file
+        return [
+            {
+                "id": self.ids[idx],
+                "title": self.titles[idx],
+                "filename": self.filenames[idx],
+                "index": idx,
+                "score": score,
+                "rank": rank
+            }
+            for rank, (idx, score) in enumerate(zip(hit_indices, hit_scores), start=1)
+        ]
+
+
+def _write_atomic(path: Path, write: Callable[[str], None]):
+    """Write to a temp file beside path and rename it over path, so readers and
+    existing memory maps never see a half-written or truncated file"""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        write(str(tmp_path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+@lru_cache(maxsize=1024)
+def _encode_query(text: str) -> bytes:
+    """Normalized float32 query embedding, cached by question text (~1.5 KB per entry)"""
+    embedding = get_encoder().encode(
+        [text], normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
+    )[0]
+    return np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+
+def get_knowledge_base() -> KnowledgeBase:
+    """Return the process-wide KnowledgeBase, building it on first use"""
+    global _KB
+    if _KB is None:
+        with _KB_LOCK:
+            if _KB is None:
+                _KB = KnowledgeBase()
+    return _KB
\ No newline at end of file
@@ -1,16 +1,21 @@
+import re
 from rest_framework import serializers
 
+# Markup that is rejected in questions (script tags, PHP and ASP/JSP openers)
+_FORBIDDEN = re.compile(r'<script|<\?php|<%', re.IGNORECASE)
+
 class AskQuestionSerializer(serializers.Serializer):
     question = serializers.CharField(max_length=2000)
     context = serializers.CharField(max_length=5000, required=False, allow_blank=True, default="")
     
     def validate_question(self, value):
-        if len(value.strip()) < 3:
+        value = value.strip()
+        if len(value) < 3:
             raise serializers.ValidationError("Question must be at least 3 characters long")
         # Basic input sanitization
-        if any(char in value for char in ['<script', '<?php', '<%']):
+        if _FORBIDDEN.search(value):
             raise serializers.ValidationError("Invalid characters in question")
-        return value.strip()
+        return value
 
 class HealthSerializer(serializers.Serializer):
     status = serializers.CharField()
@@ -21,4 +26,5 @@ class MetricsSerializer(serializers.Serializer):
     tool_calls = serializers.IntegerField()
     retrieval_calls = serializers.IntegerField()
     avg_response_time_ms = serializers.FloatField()
-    uptime_seconds = serializers.IntegerField()
\ No newline at end of file
+    uptime_seconds = serializers.IntegerField()
+    log_dropped = serializers.IntegerField()
\ No newline at end of file
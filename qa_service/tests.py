@@ -1,8 +1,22 @@
+import asyncio
+import json
+import tempfile
+import threading
 import unittest
-from django.test import TestCase
+import uuid
+import zlib
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
 from .tools import SettlementCalculator, TerzaghiBearingCapacity
-from .knowledge_base import KnowledgeBase
+from .knowledge_base import KnowledgeBase, _encode_query
 from .agent import TechnicalAgent
+from .models import QueryLog
+from .serializers import AskQuestionSerializer
+from . import _embed_model, _log_queue, knowledge_base, views
 
 class TestSettlementCalculator(TestCase):
     def setUp(self):
@@ -50,6 +64,21 @@ class TestTerzaghiBearingCapacity(TestCase):
         with self.assertRaises(ValueError):
             self.calc.calculate(B=2, gamma=18, Df=1.5, friction_angle=50)  # Invalid angle
 
+class TestAskQuestionSerializer(TestCase):
+    def test_rejects_markup_in_any_case(self):
+        for question in ["<SCRIPT>alert(1)</SCRIPT>", "what is <ScRiPt src=x>", "<?PHP echo 1; ?>", "run <% code %>"]:
+            serializer = AskQuestionSerializer(data={"question": question})
+            self.assertFalse(serializer.is_valid(), question)
+            self.assertIn("question", serializer.errors)
+    
+    def test_returns_stripped_question(self):
+        serializer = AskQuestionSerializer(data={"question": "  What is CPT?  \n"})
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(serializer.validated_data["question"], "What is CPT?")
+        
+        # Too short once surrounding whitespace is stripped
+        self.assertFalse(AskQuestionSerializer(data={"question": "  ab  "}).is_valid())
+
 class TestKnowledgeBase(TestCase):
     def setUp(self):
         self.kb = KnowledgeBase()
@@ -66,4 +95,364 @@ class TestKnowledgeBase(TestCase):
             self.assertIn('id', doc)
             self.assertIn('title', doc)
             self.assertIn('content', doc)
-            self.assertIn('filename', doc)
\ No newline at end of file
+            self.assertIn('filename', doc)
+
+class StubEncoder:
+    """Deterministic offline encoder that records each encode() batch"""
+    def __init__(self, dimension=16):
+        self.dimension = dimension
+        self.batches = []
+    
+    def encode(self, texts, batch_size=32, normalize_embeddings=False, convert_to_numpy=True, show_progress_bar=False):
+        self.batches.append(len(texts))
+        embeddings = np.stack([
+            np.random.default_rng(zlib.crc32(text.encode('utf-8'))).standard_normal(self.dimension)
+            for text in texts
+        ]).astype(np.float32)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+class StubTokenizer:
+    """Whitespace tokenizer: token ids are 1, 2, ... in order, 0 is padding"""
+    def __call__(self, texts, padding=True, truncation=True, max_length=None, return_tensors="np"):
+        width = max(len(text.split()) for text in texts)
+        input_ids = np.zeros((len(texts), width), dtype=np.int64)
+        next_id = 1
+        for row, text in enumerate(texts):
+            for col, _ in enumerate(text.split()):
+                input_ids[row, col] = next_id
+                next_id += 1
+        return {"input_ids": input_ids, "attention_mask": (input_ids > 0).astype(np.int64)}
+
+class StubOnnxSession:
+    """Stands in for onnxruntime.InferenceSession; each token embeds as its id repeated"""
+    dimension = 4
+    
+    def __init__(self, path, options=None, providers=None):
+        pass
+    
+    def get_inputs(self):
+        return [SimpleNamespace(name="input_ids"), SimpleNamespace(name="attention_mask")]
+    
+    def get_outputs(self):
+        return [SimpleNamespace(shape=["batch", "sequence", self.dimension])]
+    
+    def run(self, output_names, inputs):
+        return [np.repeat(inputs["input_ids"][..., None], self.dimension, axis=-1).astype(np.float32)]
+
+class TestOnnxEncoder(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        (Path(tmp.name) / "model.onnx").write_bytes(b"")
+        
+        ort = mock.Mock(InferenceSession=StubOnnxSession)
+        with mock.patch.dict("sys.modules", {"onnxruntime": ort}), \
+                mock.patch("transformers.AutoTokenizer.from_pretrained", return_value=StubTokenizer()):
+            self.encoder = _embed_model.OnnxEncoder(tmp.name, num_threads=1)
+    
+    def test_mean_pools_real_tokens(self):
+        embeddings = self.encoder.encode(["a b", "c"])
+        # "a b" has ids 1 and 2; "c" has id 3 plus one padding token that must be ignored
+        np.testing.assert_allclose(embeddings, [[1.5] * 4, [3.0] * 4])
+        
+        normalized = self.encoder.encode(["a b", "c"], normalize_embeddings=True)
+        np.testing.assert_allclose(np.linalg.norm(normalized, axis=1), [1.0, 1.0], rtol=1e-6)
+        self.assertEqual(self.encoder.model_id, "all-MiniLM-L6-v2:onnx:model.onnx")
+    
+    def test_empty_input(self):
+        embeddings = self.encoder.encode([])
+        self.assertEqual(embeddings.shape, (0, StubOnnxSession.dimension))
+        self.assertEqual(embeddings.dtype, np.float32)
+    
+    def test_unloadable_model_falls_back(self):
+        saved = (_embed_model._MODEL, _embed_model._MODEL_ID)
+        self.addCleanup(lambda: setattr(_embed_model, "_MODEL", saved[0]))
+        self.addCleanup(lambda: setattr(_embed_model, "_MODEL_ID", saved[1]))
+        _embed_model._MODEL = None
+        
+        fallback = mock.Mock()
+        with mock.patch.dict("os.environ", {"QA_ONNX_MODEL_DIR": "onnx_model"}), \
+                mock.patch.object(_embed_model, "OnnxEncoder", side_effect=RuntimeError("invalid model")), \
+                mock.patch("sentence_transformers.SentenceTransformer", return_value=fallback), \
+                self.assertLogs("qa_service._embed_model", level="WARNING"):
+            self.assertIs(_embed_model.get_encoder(), fallback)
+        self.assertEqual(_embed_model._MODEL_ID, _embed_model.MODEL_NAME)
+
+class TestKnowledgeBasePersistence(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.data_dir = Path(tmp.name)
+        
+        saved = (_embed_model._MODEL, _embed_model._MODEL_ID)
+        self.addCleanup(lambda: setattr(_embed_model, "_MODEL", saved[0]))
+        self.addCleanup(lambda: setattr(_embed_model, "_MODEL_ID", saved[1]))
+        self.addCleanup(_encode_query.cache_clear)
+        _encode_query.cache_clear()
+        
+        self.encoder = StubEncoder()
+        _embed_model._MODEL = self.encoder
+        _embed_model._MODEL_ID = "stub"
+        self.kb = KnowledgeBase(data_dir=str(self.data_dir))
+        self.encoder.batches.clear()
+    
+    def _corpus_encoded(self):
+        return len(self.kb.ids) in self.encoder.batches
+    
+    def test_matching_fingerprint_reuses_index(self):
+        self.kb = KnowledgeBase(data_dir=str(self.data_dir))
+        self.assertFalse(self._corpus_encoded())
+        self.assertEqual(self.kb.index.ntotal, len(self.kb.ids))
+        self.assertFalse([path.name for path in self.data_dir.iterdir() if path.name.endswith(".tmp")])
+    
+    def test_fingerprint_mismatch_rebuilds(self):
+        _embed_model._MODEL_ID = "stub-v2"
+        self.kb = KnowledgeBase(data_dir=str(self.data_dir))
+        self.assertTrue(self._corpus_encoded())
+        with open(self.data_dir / "meta.json", encoding='utf-8') as f:
+            self.assertEqual(json.load(f)["model"], "stub-v2")
+    
+    def test_corrupt_index_rebuilds_from_embeddings(self):
+        (self.data_dir / "faiss.index").write_bytes(b"not a faiss index")
+        self.kb = KnowledgeBase(data_dir=str(self.data_dir))
+        self.assertFalse(self._corpus_encoded())
+        self.assertEqual(self.kb.index.ntotal, len(self.kb.ids))
+        self.assertEqual(len(self.kb.search("CPT settlement", k=2)), 2)
+        
+        # The rebuilt index was saved and loads normally next time
+        with mock.patch.object(knowledge_base.logger, "warning") as warning:
+            KnowledgeBase(data_dir=str(self.data_dir))
+        warning.assert_not_called()
+        self.assertFalse(self._corpus_encoded())
+    
+    def test_short_embeddings_file_rebuilds(self):
+        emb_path = self.data_dir / "embeddings.f32"
+        emb_path.write_bytes(emb_path.read_bytes()[:64])
+        self.kb = KnowledgeBase(data_dir=str(self.data_dir))
+        self.assertTrue(self._corpus_encoded())
+        self.assertEqual(self.kb.embeddings.shape, (len(self.kb.ids), self.encoder.dimension))
+    
+    def test_changed_documents_rewrite_files(self):
+        doc_path = self.data_dir / self.kb.filenames[0]
+        doc_path.write_text("stale copy", encoding='utf-8')
+        
+        # Unchanged documents leave files on disk alone
+        KnowledgeBase(data_dir=str(self.data_dir))
+        self.assertEqual(doc_path.read_text(encoding='utf-8'), "stale copy")
+        
+        # A stored hash from older documents rewrites them
+        meta_path = self.data_dir / "meta.json"
+        meta = json.loads(meta_path.read_text(encoding='utf-8'))
+        meta_path.write_text(json.dumps(dict(meta, hash="older")), encoding='utf-8')
+        self.kb = KnowledgeBase(data_dir=str(self.data_dir))
+        self.assertEqual(doc_path.read_text(encoding='utf-8'), self.kb.contents[0])
+    
+    def test_search_drops_padding(self):
+        # k above the corpus size makes FAISS pad the result with -1
+        results = self.kb.search("CPT settlement", k=len(self.kb.ids) + 4)
+        self.assertEqual(len(results), len(self.kb.ids))
+        self.assertEqual([result['rank'] for result in results], list(range(1, len(self.kb.ids) + 1)))
+        self.assertEqual(sorted(result['index'] for result in results), list(range(len(self.kb.ids))))
+
+class EmptyKnowledgeBase:
+    """Stand-in knowledge base that never returns documents"""
+    def search(self, query, k=3):
+        return []
+
+class OneDocKnowledgeBase:
+    """Stand-in knowledge base that always returns the same document"""
+    def search(self, query, k=3):
+        return [{"id": "doc", "title": "Doc", "filename": "doc.md", "index": 0, "score": 0.9, "rank": 1}]
+    
+    def get_content(self, idx):
+        return "Liquefaction is a loss of soil strength during shaking."
+
+class StubAsyncOllama:
+    """Async Ollama client stand-in that streams a fixed answer and counts calls"""
+    def __init__(self):
+        self.calls = 0
+    
+    async def generate(self, model, prompt, stream=False):
+        self.calls += 1
+        
+        async def chunks():
+            yield {"response": "Soil loses strength."}
+        return chunks()
+
+class TestTechnicalAgent(TestCase):
+    def setUp(self):
+        self.agent = TechnicalAgent(kb=EmptyKnowledgeBase())
+    
+    def test_parameter_extraction(self):
+        params = self.agent._extract_params(
+            "Calculate bearing capacity for B = 2, gamma = 18, Df = 1.5, friction angle = 30"
+        )
+        self.assertEqual(
+            self.agent._extract_bearing_capacity_params(params),
+            {'B': 2.0, 'gamma': 18.0, 'Df': 1.5, 'friction_angle': 30.0}
+        )
+        self.assertIsNone(self.agent._extract_settlement_params(params))
+        
+        params = self.agent._extract_params("Settlement for load = 100 and Young's modulus = 25000")
+        self.assertEqual(self.agent._extract_settlement_params(params), (100.0, 25000.0))
+    
+    def test_malformed_context_value_is_ignored(self):
+        result = self.agent.process_question(
+            "Calculate settlement for load = 100 and Young's modulus = 25000",
+            context="Site visit date: 2024.05.01"
+        )
+        self.assertEqual(result['tools_used'], ["settlement_calculator"])
+        self.assertIn("0.0040", result['answer'])
+        
+        result = self.agent.process_question(
+            "Calculate bearing capacity for B = 2, gamma = 18, Df = 1.5, friction angle = 30",
+            context="Design load = 1.5.2"
+        )
+        self.assertEqual(result['tools_used'], ["bearing_capacity_calculator"])
+    
+    def test_tool_answer_and_trace(self):
+        result = self.agent.process_question("Calculate settlement for load = 100 and Young's modulus = 25000")
+        self.assertEqual(result['tools_used'], ["settlement_calculator"])
+        self.assertIn("0.0040", result['answer'])
+        steps = [step['step'] for step in result['trace']]
+        self.assertEqual(steps, ["retrieval", "settlement_tool", "ollama_skipped", "final_answer_generation"])
+        self.assertEqual(result['trace'][1]['inputs'], {"load": 100.0, "youngs_modulus": 25000.0})
+    
+    def test_out_of_scope_prefilter(self):
+        result = self.agent.process_question("Hello there")
+        self.assertFalse(result['retrieval_used'])
+        self.assertEqual([step['step'] for step in result['trace']], ["out_of_scope"])
+        
+        # A short question that mentions the domain still goes through retrieval
+        result = self.agent.process_question("Explain liquefaction")
+        self.assertTrue(result['retrieval_used'])
+        
+        # So do short questions about terms and acronyms the documents define
+        for question in ["What is qc?", "Define CRR", "What is CSR?", "What is Ic?",
+                         "Explain friction ratio", "Define fines content", "Magnitude scaling factor"]:
+            result = self.agent.process_question(question)
+            self.assertTrue(result['retrieval_used'], question)
+        
+        # Acronyms only count as whole words
+        result = self.agent.process_question("Play basic music")
+        self.assertFalse(result['retrieval_used'])
+    
+    def test_async_questions_share_client(self):
+        agent = TechnicalAgent(kb=OneDocKnowledgeBase())
+        client = StubAsyncOllama()
+        
+        async def ask_twice():
+            return await asyncio.gather(
+                agent.aprocess_question("Explain liquefaction", client=client),
+                agent.aprocess_question("Explain liquefaction triggering", client=client)
+            )
+        
+        results = asyncio.run(ask_twice())
+        self.assertEqual(client.calls, 2)
+        self.assertTrue(all(result['answer'].endswith("Soil loses strength.") for result in results))
+
+class TestQueryLogQueue(TransactionTestCase):
+    def setUp(self):
+        # Stop any writer left by earlier tests so each test controls it
+        _log_queue._shutdown()
+    
+    def _row(self, i):
+        return {
+            "trace_id": uuid.uuid4(),
+            "question": f"question {i}",
+            "answer": "answer",
+            "citations": [],
+            "tools_used": ["settlement_calculator"],
+            "retrieval_used": True,
+            "duration_ms": 10
+        }
+    
+    def _enqueue_and_wait(self, entry, timeout=5.0):
+        # Read the table only after the writer thread is done with it; the
+        # shared in-memory test database raises "table is locked" otherwise
+        written = threading.Event()
+        write = _log_queue._write
+        
+        def write_and_signal(batch):
+            write(batch)
+            written.set()
+        
+        with mock.patch.object(_log_queue, "_write", write_and_signal):
+            _log_queue.enqueue(entry)
+            self.assertTrue(written.wait(timeout))
+    
+    def test_batch_write(self):
+        batch = [self._row(i) for i in range(3)]
+        _log_queue._write(batch)
+        self.assertEqual(QueryLog.objects.count(), 3)
+        self.assertEqual(QueryLog.objects.filter(tools_used=["settlement_calculator"]).count(), 3)
+    
+    def test_failed_write_logs_trace_ids(self):
+        batch = [self._row(i) for i in range(2)]
+        batch[1]["not_a_field"] = True
+        with self.assertLogs("qa_service._log_queue", level="ERROR") as logs:
+            _log_queue._write(batch)
+        for entry in batch:
+            self.assertIn(str(entry["trace_id"]), logs.output[0])
+        self.assertEqual(QueryLog.objects.count(), 0)
+    
+    def test_enqueue_reaches_database(self):
+        self._enqueue_and_wait(self._row(0))
+        self.assertEqual(QueryLog.objects.count(), 1)
+    
+    def test_enqueue_restarts_dead_writer(self):
+        # A worker forked after the app loaded inherits a writer Thread whose thread is not running
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        _log_queue._worker = dead
+        
+        self._enqueue_and_wait(self._row(0))
+        self.assertIsNot(_log_queue._worker, dead)
+        self.assertEqual(QueryLog.objects.count(), 1)
+    
+    def test_shutdown_writes_pending_rows(self):
+        for i in range(3):
+            _log_queue.enqueue(self._row(i))
+        _log_queue._shutdown()
+        self.assertFalse(_log_queue._worker.is_alive())
+        self.assertEqual(QueryLog.objects.count(), 3)
+    
+    def test_shutdown_without_writer(self):
+        for i in range(3):
+            _log_queue._queue.put_nowait(self._row(i))
+        _log_queue._shutdown()
+        self.assertEqual(QueryLog.objects.count(), 3)
+    
+    def test_fork_resets_dropped_count(self):
+        _log_queue._dropped = 5
+        _log_queue._reset_after_fork()
+        self.assertEqual(_log_queue.dropped(), 0)
+
+class TestAskQuestionCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.agent = TechnicalAgent(kb=EmptyKnowledgeBase())
+    
+    def test_repeated_question_is_served_from_cache(self):
+        payload = {"question": "Calculate settlement for load = 100 and Young's modulus = 25000"}
+        tool_calls = views.metrics_store.tool_calls
+        
+        with mock.patch.object(views, "get_agent", return_value=self.agent), \
+                mock.patch.object(self.agent, "process_question", wraps=self.agent.process_question) as process, \
+                mock.patch.object(_log_queue, "enqueue") as enqueue:
+            first = self.client.post("/ask/", payload, content_type="application/json")
+            second = self.client.post("/ask/", payload, content_type="application/json")
+        
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.json()['answer'], first.json()['answer'])
+        self.assertNotEqual(second.json()['trace_id'], first.json()['trace_id'])
+        self.assertEqual(process.call_count, 1)
+        # Only the first request ran the settlement tool; the hit reports just the lookup
+        self.assertEqual(views.metrics_store.tool_calls - tool_calls, 1)
+        self.assertEqual([step['step'] for step in second.json()['trace']], ["cache_hit"])
+        hit_row = enqueue.call_args_list[1].args[0]
+        self.assertEqual(hit_row['tools_used'], [])
+        self.assertFalse(hit_row['retrieval_used'])
\ No newline at end of file
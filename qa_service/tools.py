@@ -1,9 +1,51 @@
 import math
-from typing import Dict, Any, Optional
+from bisect import bisect_right
+from typing import Dict, Any, Optional, Sequence, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+def _settlement(load: float, youngs_modulus: float) -> float:
+    """Immediate settlement kernel: settlement = load / Young's modulus"""
+    return load / youngs_modulus
+
+def _terzaghi(B: float, gamma: float, Df: float, Nq: float, Nr: float) -> Tuple[float, float, float]:
+    """Terzaghi kernel for cohesionless soils: returns (q_ult, depth_term, width_term)"""
+    depth_term = gamma * Df * Nq
+    width_term = 0.5 * gamma * B * Nr
+    return depth_term + width_term, depth_term, width_term
+
+def _interpolate(friction_angle: float, angles: Sequence[float], nq: Sequence[float],
+                 nr: Sequence[float]) -> Tuple[float, float]:
+    """Clamped linear interpolation of (Nq, Nr) over sorted angle lookup tables"""
+    # Upper bracket index; bisecting right makes a tabulated angle its own lower
+    # bracket so table values come back exactly
+    i = min(max(bisect_right(angles, friction_angle), 1), len(angles) - 1)
+    lo = i - 1
+    
+    # Clamped ratio: angles outside the table take the end values
+    ratio = (friction_angle - angles[lo]) / (angles[i] - angles[lo])
+    ratio = min(max(ratio, 0.0), 1.0)
+    
+    return nq[lo] + ratio * (nq[i] - nq[lo]), nr[lo] + ratio * (nr[i] - nr[lo])
+
+def _terzaghi_core(B: float, gamma: float, Df: float, friction_angle: float,
+                   angles: Sequence[float], nq: Sequence[float],
+                   nr: Sequence[float]) -> Tuple[float, float, float, float, float]:
+    """Factor lookup plus Terzaghi kernel: returns (q_ult, Nq, Nr, depth_term, width_term)"""
+    Nq, Nr = _interpolate(friction_angle, angles, nq, nr)
+    q_ult, depth_term, width_term = _terzaghi(B, gamma, Df, Nq, Nr)
+    return q_ult, Nq, Nr, depth_term, width_term
+
+def _factor_table(factors: Dict[int, Dict[str, float]]) -> Tuple[Tuple[float, ...], Tuple[float, ...], Tuple[float, ...]]:
+    """Split a {angle: {"Nq", "Nr"}} table into sorted angle, Nq and Nr tuples"""
+    angles = sorted(factors)
+    return (
+        tuple(float(angle) for angle in angles),
+        tuple(factors[angle]["Nq"] for angle in angles),
+        tuple(factors[angle]["Nr"] for angle in angles)
+    )
+
 class SettlementCalculator:
     """Tool for immediate settlement calculation: settlement = load / Young's modulus"""
     
@@ -23,7 +65,7 @@ class SettlementCalculator:
             if load < 0:
                 raise ValueError("Load cannot be negative")
             
-            settlement = load / youngs_modulus
+            settlement = _settlement(load, youngs_modulus)
             
             return {
                 "settlement": settlement,
@@ -60,28 +102,20 @@ class TerzaghiBearingCapacity:
         45: {"Nq": 134.9, "Nr": 200.8}
     }
     
+    # Flat lookup tables built once from the dict above
+    _ANGLES, _NQS, _NRS = _factor_table(BEARING_CAPACITY_FACTORS)
+    
     @staticmethod
     def _interpolate_factors(friction_angle: float) -> Dict[str, float]:
         """Interpolate bearing capacity factors for given friction angle"""
-        angles = sorted(TerzaghiBearingCapacity.BEARING_CAPACITY_FACTORS.keys())
-        
-        if friction_angle <= angles[0]:
-            return TerzaghiBearingCapacity.BEARING_CAPACITY_FACTORS[angles[0]]
-        elif friction_angle >= angles[-1]:
-            return TerzaghiBearingCapacity.BEARING_CAPACITY_FACTORS[angles[-1]]
-        
-        # Linear interpolation
-        for i in range(len(angles) - 1):
-            if angles[i] <= friction_angle <= angles[i + 1]:
-                lower = TerzaghiBearingCapacity.BEARING_CAPACITY_FACTORS[angles[i]]
-                upper = TerzaghiBearingCapacity.BEARING_CAPACITY_FACTORS[angles[i + 1]]
-                
-                ratio = (friction_angle - angles[i]) / (angles[i + 1] - angles[i])
-                
-                return {
-                    "Nq": lower["Nq"] + ratio * (upper["Nq"] - lower["Nq"]),
-                    "Nr": lower["Nr"] + ratio * (upper["Nr"] - lower["Nr"])
-                }
+        Nq, Nr = TerzaghiBearingCapacity._interpolate_factors_fast(friction_angle)
+        return {"Nq": Nq, "Nr": Nr}
+    
+    @staticmethod
+    def _interpolate_factors_fast(friction_angle: float) -> Tuple[float, float]:
+        """Interpolated (Nq, Nr) for given friction angle, without building a dict"""
+        cls = TerzaghiBearingCapacity
+        return _interpolate(friction_angle, cls._ANGLES, cls._NQS, cls._NRS)
     
     @staticmethod
     def calculate(B: float, gamma: float, Df: float, friction_angle: float) -> Dict[str, Any]:
@@ -101,14 +135,11 @@ class TerzaghiBearingCapacity:
             if not 0 <= friction_angle <= 45:
                 raise ValueError("Friction angle must be between 0 and 45 degrees")
             
-            factors = TerzaghiBearingCapacity._interpolate_factors(friction_angle)
-            Nq = factors["Nq"]
-            Nr = factors["Nr"]
-            
             # Terzaghi equation: q_ult = γ*Df*Nq + 0.5*γ*B*Nr
-            term1 = gamma * Df * Nq
-            term2 = 0.5 * gamma * B * Nr
-            q_ult = term1 + term2
+            cls = TerzaghiBearingCapacity
+            q_ult, Nq, Nr, term1, term2 = _terzaghi_core(
+                B, gamma, Df, friction_angle, cls._ANGLES, cls._NQS, cls._NRS
+            )
             
             return {
                 "ultimate_bearing_capacity": q_ult,